@@ -1,5 +1,6 @@
 """Probability distributions."""
 
+import math
 from abc import ABC, abstractmethod
 from typing import Any, Dict, List, Optional, Tuple, Union
 
@@ -8,6 +9,7 @@ import torch as th
 from gym import spaces
 from torch import nn
 from torch.distributions import Bernoulli, Categorical, Normal
+from torch.nn import functional as F
 
 from stable_baselines3.common.preprocessing import get_action_dim
 
@@ -102,14 +104,56 @@ def sum_independent_dims(tensor: th.Tensor) -> th.Tensor:
     Continuous actions are usually considered to be independent,
     so we can sum components of the ``log_prob`` or the entropy.
 
-    :param tensor: shape: (n_batch, n_actions) or (n_batch,)
-    :return: shape: (n_batch,)
+    :param tensor: shape: (n_batch, n_actions) or (n_actions,)
+    :return: shape: (n_batch,) or scalar
     """
-    if len(tensor.shape) > 1:
-        tensor = tensor.sum(dim=1)
-    else:
-        tensor = tensor.sum()
-    return tensor
+    return tensor.sum(dim=-1)
+
+
+@th.jit.script
+def diag_gaussian_log_prob(actions: th.Tensor, mean_actions: th.Tensor, log_std: th.Tensor) -> th.Tensor:
+    """
+    Log likelihood of actions for a Gaussian distribution with diagonal covariance matrix,
+    summed along the action dimension.
+    This is a TorchScript version of ``Normal(mean_actions, log_std.exp()).log_prob(actions)``
+    which avoids the overhead of ``torch.distributions``.
+
+    :param actions:
+    :param mean_actions:
+    :param log_std:
+    :return:
+    """
+    # The normalization constant is added once, after the reduction
+    log_prob = (-0.5 * (actions - mean_actions) ** 2 * th.exp(-2.0 * log_std) - log_std).sum(dim=-1)
+    return log_prob - 0.5 * math.log(2.0 * math.pi) * actions.shape[-1]
+
+
+@th.jit.script
+def tanh_squash_correction(gaussian_actions: th.Tensor) -> th.Tensor:
+    """
+    Squash correction (from original SAC implementation): ``log(1 - tanh(x)^2)``.
+    We use the numerically stable identity ``log(1 - tanh(x)^2) = 2 * (log(2) - x - softplus(-2x))``
+    which does not require an epsilon to avoid NaN.
+
+    :param gaussian_actions: the actions before squashing
+    :return:
+    """
+    return 2.0 * (math.log(2.0) - gaussian_actions - F.softplus(-2.0 * gaussian_actions))
+
+
+@th.jit.script
+def squashed_diag_gaussian_log_prob(gaussian_actions: th.Tensor, mean_actions: th.Tensor, log_std: th.Tensor) -> th.Tensor:
+    """
+    Log likelihood of squashed actions (using tanh) for a Gaussian distribution
+    with diagonal covariance matrix, summed along the action dimension.
+
+    :param gaussian_actions: the actions before squashing
+    :param mean_actions:
+    :param log_std:
+    :return:
+    """
+    log_prob = diag_gaussian_log_prob(gaussian_actions, mean_actions, log_std)
+    return log_prob - tanh_squash_correction(gaussian_actions).sum(dim=-1)
 
 
 class DiagGaussianDistribution(Distribution):
@@ -148,8 +192,10 @@ class DiagGaussianDistribution(Distribution):
         :param log_std:
         :return:
         """
-        action_std = th.ones_like(mean_actions) * log_std.exp()
-        self.distribution = Normal(mean_actions, action_std)
+        # We do not create a ``Normal`` object to avoid the overhead of ``torch.distributions``.
+        # The log std is broadcast to the shape of the mean without copy.
+        self.mean_actions = mean_actions
+        self.log_std = log_std.expand_as(mean_actions)
         return self
 
     def log_prob(self, actions: th.Tensor) -> th.Tensor:
@@ -160,18 +206,30 @@ class DiagGaussianDistribution(Distribution):
         :param actions:
         :return:
         """
-        log_prob = self.distribution.log_prob(actions)
-        return sum_independent_dims(log_prob)
+        return diag_gaussian_log_prob(actions, self.mean_actions, self.log_std)
 
     def entropy(self) -> th.Tensor:
-        return sum_independent_dims(self.distribution.entropy())
+        # Entropy of a Gaussian: 0.5 + 0.5 * log(2 * pi) + log(std)
+        return sum_independent_dims(0.5 + 0.5 * math.log(2.0 * math.pi) + self.log_std)
 
     def sample(self) -> th.Tensor:
         # Reparametrization trick to pass gradients
-        return self.distribution.rsample()
+        return self.mean_actions + th.exp(self.log_std) * th.randn_like(self.mean_actions)
+
+    def sample_n(self, n_samples: int) -> th.Tensor:
+        """
+        Draw several samples at once, using a single call to the random number generator.
+
+        :param n_samples: Number of samples to draw
+        :return: shape: (n_samples, n_batch, n_actions)
+        """
+        mean = self.mean_actions
+        noise = th.randn((n_samples,) + mean.shape, device=mean.device, dtype=mean.dtype)
+        # Reparametrization trick to pass gradients
+        return mean + th.exp(self.log_std) * noise
 
     def mode(self) -> th.Tensor:
-        return self.distribution.mean
+        return self.mean_actions
 
     def actions_from_params(self, mean_actions: th.Tensor, log_std: th.Tensor, deterministic: bool = False) -> th.Tensor:
         # Update the proba distribution
@@ -198,11 +256,11 @@ class SquashedDiagGaussianDistribution(DiagGaussianDistribution):
 
     :param action_dim: Dimension of the action space.
     :param epsilon: small value to avoid NaN due to numerical imprecision.
+        Unused: the squash correction is now computed in a numerically stable way.
     """
 
     def __init__(self, action_dim: int, epsilon: float = 1e-6):
         super(SquashedDiagGaussianDistribution, self).__init__(action_dim)
-        # Avoid NaN (prevents division by zero or log of zero)
         self.epsilon = epsilon
         self.gaussian_actions = None
 
@@ -212,18 +270,13 @@ class SquashedDiagGaussianDistribution(DiagGaussianDistribution):
 
     def log_prob(self, actions: th.Tensor, gaussian_actions: Optional[th.Tensor] = None) -> th.Tensor:
         # Inverse tanh
-        # Naive implementation (not stable): 0.5 * torch.log((1 + x) / (1 - x))
-        # We use numpy to avoid numerical instability
         if gaussian_actions is None:
             # It will be clipped to avoid NaN when inversing tanh
             gaussian_actions = TanhBijector.inverse(actions)
 
-        # Log likelihood for a Gaussian distribution
-        log_prob = super(SquashedDiagGaussianDistribution, self).log_prob(gaussian_actions)
-        # Squash correction (from original SAC implementation)
+        # Log likelihood for a Gaussian distribution with squash correction
         # this comes from the fact that tanh is bijective and differentiable
-        log_prob -= th.sum(th.log(1 - actions ** 2 + self.epsilon), dim=1)
-        return log_prob
+        return squashed_diag_gaussian_log_prob(gaussian_actions, self.mean_actions, self.log_std)
 
     def entropy(self) -> Optional[th.Tensor]:
         # No analytical form,
@@ -235,6 +288,10 @@ class SquashedDiagGaussianDistribution(DiagGaussianDistribution):
         self.gaussian_actions = super().sample()
         return th.tanh(self.gaussian_actions)
 
+    def sample_n(self, n_samples: int) -> th.Tensor:
+        self.gaussian_actions = super().sample_n(n_samples)
+        return th.tanh(self.gaussian_actions)
+
     def mode(self) -> th.Tensor:
         self.gaussian_actions = super().mode()
         # Squash the output
@@ -256,6 +313,7 @@ class CategoricalDistribution(Distribution):
     def __init__(self, action_dim: int):
         super(CategoricalDistribution, self).__init__()
         self.action_dim = action_dim
+        self._log_probs = None
 
     def proba_distribution_net(self, latent_dim: int) -> nn.Module:
         """
@@ -272,19 +330,24 @@ class CategoricalDistribution(Distribution):
 
     def proba_distribution(self, action_logits: th.Tensor) -> "CategoricalDistribution":
         self.distribution = Categorical(logits=action_logits)
+        # Categorical already normalizes the logits, i.e. computes log_softmax(action_logits)
+        self._log_probs = self.distribution.logits
         return self
 
     def log_prob(self, actions: th.Tensor) -> th.Tensor:
-        return self.distribution.log_prob(actions)
+        return self._log_probs.gather(-1, actions.long().unsqueeze(-1)).squeeze(-1)
 
     def entropy(self) -> th.Tensor:
-        return self.distribution.entropy()
+        # Avoid NaN (0 * -inf) when a probability is zero, as done in ``Categorical.entropy()``
+        log_probs = self._log_probs.clamp(min=th.finfo(self._log_probs.dtype).min)
+        return -(log_probs.exp() * log_probs).sum(dim=-1)
 
     def sample(self) -> th.Tensor:
         return self.distribution.sample()
 
     def mode(self) -> th.Tensor:
-        return th.argmax(self.distribution.probs, dim=1)
+        # Avoid computing the softmax
+        return th.argmax(self._log_probs, dim=-1)
 
     def actions_from_params(self, action_logits: th.Tensor, deterministic: bool = False) -> th.Tensor:
         # Update the proba distribution
@@ -329,7 +392,12 @@ class MultiCategoricalDistribution(Distribution):
     def log_prob(self, actions: th.Tensor) -> th.Tensor:
         # Extract each discrete action and compute log prob for their respective distributions
         return th.stack(
-            [dist.log_prob(action) for dist, action in zip(self.distribution, th.unbind(actions, dim=1))], dim=1
+            # Categorical already normalizes the logits, i.e. computes log_softmax(action_logits)
+            [
+                dist.logits.gather(-1, action.long().unsqueeze(-1)).squeeze(-1)
+                for dist, action in zip(self.distribution, th.unbind(actions, dim=1))
+            ],
+            dim=1,
         ).sum(dim=1)
 
     def entropy(self) -> th.Tensor:
@@ -339,7 +407,8 @@ class MultiCategoricalDistribution(Distribution):
         return th.stack([dist.sample() for dist in self.distribution], dim=1)
 
     def mode(self) -> th.Tensor:
-        return th.stack([th.argmax(dist.probs, dim=1) for dist in self.distribution], dim=1)
+        # The softmax is monotonic, so there is no need to compute the probabilities
+        return th.stack([th.argmax(dist.logits, dim=1) for dist in self.distribution], dim=1)
 
     def actions_from_params(self, action_logits: th.Tensor, deterministic: bool = False) -> th.Tensor:
         # Update the proba distribution
@@ -389,7 +458,8 @@ class BernoulliDistribution(Distribution):
         return self.distribution.sample()
 
     def mode(self) -> th.Tensor:
-        return th.round(self.distribution.probs)
+        # Same as rounding the probabilities, without computing the sigmoid
+        return (self.distribution.logits > 0).to(self.distribution.logits.dtype)
 
     def actions_from_params(self, action_logits: th.Tensor, deterministic: bool = False) -> th.Tensor:
         # Update the proba distribution
@@ -438,10 +508,18 @@ class StateDependentNoiseDistribution(Distribution):
         self.latent_sde_dim = None
         self.mean_actions = None
         self.log_std = None
-        self.weights_dist = None
         self.exploration_mat = None
         self.exploration_matrices = None
         self._latent_sde = None
+        # Cache for the std, see ``_get_cached_std()``
+        self._std = None
+        self._std_log_std = None
+        self._std_version = None
+        self._std_data_ptr = None
+        self._std_squared = None
+        # Epsilon tensors, per device and dtype, see ``_get_epsilon()``
+        self._epsilon_tensors = {}
+        self._noise_buffer = None
         self.use_expln = use_expln
         self.full_std = full_std
         self.epsilon = epsilon
@@ -462,11 +540,8 @@ class StateDependentNoiseDistribution(Distribution):
         if self.use_expln:
             # From gSDE paper, it allows to keep variance
             # above zero and prevent it from growing too fast
-            below_threshold = th.exp(log_std) * (log_std <= 0)
-            # Avoid NaN: zeros values that are below zero
-            safe_log_std = log_std * (log_std > 0) + self.epsilon
-            above_threshold = (th.log1p(safe_log_std) + 1.0) * (log_std > 0)
-            std = below_threshold + above_threshold
+            # Avoid NaN: clip values that are below zero before calling log1p
+            std = th.where(log_std <= 0, th.exp(log_std), th.log1p(log_std.clamp_min(0.0)) + 1.0)
         else:
             # Use normal exponential
             std = th.exp(log_std)
@@ -474,7 +549,66 @@ class StateDependentNoiseDistribution(Distribution):
         if self.full_std:
             return std
         # Reduce the number of parameters:
-        return th.ones(self.latent_sde_dim, self.action_dim).to(log_std.device) * std
+        return std.expand(self.latent_sde_dim, self.action_dim)
+
+    def _get_cached_std(self, log_std: th.Tensor) -> th.Tensor:
+        """
+        Same as ``get_std()`` but re-use the previous result when no gradient is needed
+        and ``log_std`` was not modified in-place in-between (e.g. by an optimizer step).
+        This avoids re-computing the std at every step when collecting rollouts.
+        It is also re-used by ``sample_weights()`` when the noise is re-sampled without gradient
+        (e.g. on-policy algorithms), off-policy algorithms re-sample it with gradient and bypass the cache.
+        Note: in-place writes through ``log_std.data`` do not increment the version counter,
+        they are only detected when they replace the underlying storage (e.g. ``.to()``, ``.half()``).
+
+        :param log_std:
+        :return:
+        """
+        if th.is_grad_enabled() and log_std.requires_grad:
+            return self.get_std(log_std)
+        # The version counter of a tensor is incremented by every in-place operation
+        if (
+            self._std is None
+            or self._std_log_std is not log_std
+            or self._std_version != log_std._version
+            or self._std_data_ptr != log_std.data_ptr()
+            or self._std.device != log_std.device
+            or self._std.dtype != log_std.dtype
+        ):
+            self._std = self.get_std(log_std)
+            self._std_log_std = log_std
+            self._std_version = log_std._version
+            self._std_data_ptr = log_std.data_ptr()
+            self._std_squared = self._std * self._std
+        return self._std
+
+    def _get_cached_std_squared(self, log_std: th.Tensor) -> th.Tensor:
+        """
+        Same as ``_get_cached_std()`` but for the squared std (variance of the weights).
+
+        :param log_std:
+        :return:
+        """
+        std = self._get_cached_std(log_std)
+        if std is self._std:
+            return self._std_squared
+        return std * std
+
+    def _get_epsilon(self, device: th.device, dtype: th.dtype) -> th.Tensor:
+        """
+        Return ``epsilon`` as a tensor of shape (action_dim,).
+        It is only created once per device and dtype, as the distribution
+        is not moved to the device together with the policy.
+
+        :param device:
+        :param dtype:
+        :return:
+        """
+        key = (device, dtype)
+        if key not in self._epsilon_tensors:
+            # Note: the default epsilon is representable in float16 (as subnormal) and bfloat16
+            self._epsilon_tensors[key] = th.full((self.action_dim,), self.epsilon, device=device, dtype=dtype)
+        return self._epsilon_tensors[key]
 
     def sample_weights(self, log_std: th.Tensor, batch_size: int = 1) -> None:
         """
@@ -484,12 +618,26 @@ class StateDependentNoiseDistribution(Distribution):
         :param log_std:
         :param batch_size:
         """
-        std = self.get_std(log_std)
-        self.weights_dist = Normal(th.zeros_like(std), std)
+        std = self._get_cached_std(log_std)
         # Reparametrization trick to pass gradients
-        self.exploration_mat = self.weights_dist.rsample()
+        self.exploration_mat = th.randn_like(std) * std
         # Pre-compute matrices in case of parallel exploration
-        self.exploration_matrices = self.weights_dist.rsample((batch_size,))
+        shape = (batch_size,) + std.shape
+        if th.is_grad_enabled() and std.requires_grad:
+            # The noise is saved for the backward pass,
+            # so it must not be modified in-place by the next call
+            # Reparametrization trick to pass gradients
+            self.exploration_matrices = th.randn(shape, device=std.device, dtype=std.dtype) * std
+            return
+        # Re-use the buffer for the (unscaled) noise when its shape does not change
+        if (
+            self._noise_buffer is None
+            or self._noise_buffer.shape != shape
+            or self._noise_buffer.device != std.device
+            or self._noise_buffer.dtype != std.dtype
+        ):
+            self._noise_buffer = th.empty(shape, device=std.device, dtype=std.dtype)
+        self.exploration_matrices = self._noise_buffer.normal_() * std
 
     def proba_distribution_net(
         self, latent_dim: int, log_std_init: float = -2.0, latent_sde_dim: Optional[int] = None
@@ -531,8 +679,12 @@ class StateDependentNoiseDistribution(Distribution):
         """
         # Stop gradient if we don't want to influence the features
         self._latent_sde = latent_sde if self.learn_features else latent_sde.detach()
-        variance = th.mm(self._latent_sde ** 2, self.get_std(log_std) ** 2)
-        self.distribution = Normal(mean_actions, th.sqrt(variance + self.epsilon))
+        std_squared = self._get_cached_std_squared(log_std)
+        # Add epsilon in the same kernel as the matrix multiplication
+        epsilon = self._get_epsilon(latent_sde.device, latent_sde.dtype)
+        variance = th.addmm(epsilon, self._latent_sde * self._latent_sde, std_squared)
+        # The output of addmm is not needed for the backward pass, so sqrt can be done in-place
+        self.distribution = Normal(mean_actions, variance.sqrt_())
         return self
 
     def log_prob(self, actions: th.Tensor) -> th.Tensor:
@@ -561,25 +713,39 @@ class StateDependentNoiseDistribution(Distribution):
         noise = self.get_noise(self._latent_sde)
         actions = self.distribution.mean + noise
         if self.bijector is not None:
-            return self.bijector.forward(actions)
+            # Same as ``self.bijector.forward(actions)`` but in-place,
+            # ``actions`` is a new tensor so it can be safely modified
+            return actions.tanh_()
         return actions
 
     def mode(self) -> th.Tensor:
+        # Note: the mean is the input of the distribution, so it must not be squashed in-place
         actions = self.distribution.mean
         if self.bijector is not None:
             return self.bijector.forward(actions)
         return actions
 
     def get_noise(self, latent_sde: th.Tensor) -> th.Tensor:
-        latent_sde = latent_sde if self.learn_features else latent_sde.detach()
+        """
+        Compute the exploration noise for the given features.
+
+        :param latent_sde: Features for gSDE
+        :return:
+        """
+        # The features stored by ``proba_distribution()`` are already detached
+        # when they are not learned, only detach features passed by other callers
+        if not self.learn_features and latent_sde.requires_grad:
+            latent_sde = latent_sde.detach()
         # Default case: only one exploration matrix
         if len(latent_sde) == 1 or len(latent_sde) != len(self.exploration_matrices):
-            return th.mm(latent_sde, self.exploration_mat)
-        # Use batch matrix multiplication for efficient computation
+            exploration_matrices = self.exploration_mat
+        else:
+            exploration_matrices = self.exploration_matrices
         # (batch_size, n_features) -> (batch_size, 1, n_features)
-        latent_sde = latent_sde.unsqueeze(1)
-        # (batch_size, 1, n_actions)
-        noise = th.bmm(latent_sde, self.exploration_matrices)
+        # th.matmul() folds the batch dimension into a single matrix multiplication
+        # when there is only one exploration matrix and uses a batch matrix multiplication otherwise
+        noise = th.matmul(latent_sde.unsqueeze(1), exploration_matrices)
+        # (batch_size, 1, n_actions) -> (batch_size, n_actions)
         return noise.squeeze(1)
 
     def actions_from_params(
@@ -604,6 +770,7 @@ class TanhBijector(object):
     TODO: use Pyro instead (https://pyro.ai/)
 
     :param epsilon: small value to avoid NaN due to numerical imprecision.
+        Unused: the squash correction is now computed in a numerically stable way.
     """
 
     def __init__(self, epsilon: float = 1e-6):
@@ -614,16 +781,6 @@ class TanhBijector(object):
     def forward(x: th.Tensor) -> th.Tensor:
         return th.tanh(x)
 
-    @staticmethod
-    def atanh(x: th.Tensor) -> th.Tensor:
-        """
-        Inverse of Tanh
-
-        Taken from Pyro: https://github.com/pyro-ppl/pyro
-        0.5 * torch.log((1 + x ) / (1 - x))
-        """
-        return 0.5 * (x.log1p() - (-x).log1p())
-
     @staticmethod
     def inverse(y: th.Tensor) -> th.Tensor:
         """
@@ -634,11 +791,11 @@ class TanhBijector(object):
         """
         eps = th.finfo(y.dtype).eps
         # Clip the action to avoid NaN
-        return TanhBijector.atanh(y.clamp(min=-1.0 + eps, max=1.0 - eps))
+        return th.atanh(y.clamp(min=-1.0 + eps, max=1.0 - eps))
 
     def log_prob_correction(self, x: th.Tensor) -> th.Tensor:
         # Squash correction (from original SAC implementation)
-        return th.log(1.0 - th.tanh(x) ** 2 + self.epsilon)
+        return tanh_squash_correction(x)
 
 
 def make_proba_distribution(
@@ -694,6 +851,13 @@ def kl_divergence(dist_true: Distribution, dist_pred: Distribution) -> th.Tensor
             dim=1,
         ).sum(dim=1)
 
+    # DiagGaussianDistribution does not rely on a PyTorch Distribution object either,
+    # same as the PyTorch implementation for Normal distributions (not summed across dimensions)
+    elif isinstance(dist_pred, DiagGaussianDistribution):
+        log_var_ratio = 2.0 * (dist_true.log_std - dist_pred.log_std)
+        mean_term = ((dist_true.mean_actions - dist_pred.mean_actions) * th.exp(-dist_pred.log_std)) ** 2
+        return 0.5 * (th.exp(log_var_ratio) + mean_term - 1.0 - log_var_ratio)
+
     # Use the PyTorch kl_divergence implementation
     else:
         return th.distributions.kl_divergence(dist_true.distribution, dist_pred.distribution)
@@ -156,15 +156,18 @@ class OnPolicyAlgorithm(BaseAlgorithm):
         n_steps = 0
         rollout_buffer.reset()
         # Sample new weights for the state dependent exploration
+        # (no gradient is needed as the noise is only used to collect rollouts)
         if self.use_sde:
-            self.policy.reset_noise(env.num_envs)
+            with th.no_grad():
+                self.policy.reset_noise(env.num_envs)
 
         callback.on_rollout_start()
 
         while n_steps < n_rollout_steps:
             if self.use_sde and self.sde_sample_freq > 0 and n_steps % self.sde_sample_freq == 0:
                 # Sample a new noise matrix
-                self.policy.reset_noise(env.num_envs)
+                with th.no_grad():
+                    self.policy.reset_noise(env.num_envs)
 
             with th.no_grad():
                 # Convert to pytorch tensor or to TensorDict
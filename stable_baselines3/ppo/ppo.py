@@ -193,8 +193,10 @@ class PPO(OnPolicyAlgorithm):
                     actions = rollout_data.actions.long().flatten()
 
                 # Re-sample the noise matrix because the log_std has changed
+                # (no gradient is needed: the noise is not used by ``evaluate_actions()``)
                 if self.use_sde:
-                    self.policy.reset_noise(self.batch_size)
+                    with th.no_grad():
+                        self.policy.reset_noise(self.batch_size)
 
                 values, log_prob, entropy = self.policy.evaluate_actions(rollout_data.observations, actions)
                 values = values.flatten()
@@ -5,6 +5,7 @@ import gym
 import numpy as np
 import pytest
 import torch as th
+from torch.distributions import Categorical, Normal
 
 from stable_baselines3 import A2C, PPO
 from stable_baselines3.common.distributions import (
@@ -15,7 +16,10 @@ from stable_baselines3.common.distributions import (
     SquashedDiagGaussianDistribution,
     StateDependentNoiseDistribution,
     TanhBijector,
+    diag_gaussian_log_prob,
     kl_divergence,
+    squashed_diag_gaussian_log_prob,
+    tanh_squash_correction,
 )
 from stable_baselines3.common.utils import set_random_seed
 
@@ -109,6 +113,207 @@ def test_sde_distribution():
     assert th.allclose(actions.std(), dist.distribution.scale.mean(), rtol=2e-3)
 
 
+@pytest.mark.parametrize("dist", [DiagGaussianDistribution(N_ACTIONS), SquashedDiagGaussianDistribution(N_ACTIONS)])
+def test_sample_n(dist):
+    set_random_seed(1)
+    n_samples, batch_size = 100000, 4
+    gaussian_mean = th.rand(batch_size, N_ACTIONS)
+    _, log_std = dist.proba_distribution_net(N_FEATURES)
+    dist = dist.proba_distribution(gaussian_mean, log_std)
+    actions = dist.sample_n(n_samples)
+    assert actions.shape == (n_samples, batch_size, N_ACTIONS)
+
+    if isinstance(dist, SquashedDiagGaussianDistribution):
+        assert th.max(th.abs(actions)) <= 1.0
+        assert th.allclose(dist.gaussian_actions.mean(dim=0), gaussian_mean, atol=2e-2)
+    else:
+        assert th.allclose(actions.mean(dim=0), gaussian_mean, atol=2e-2)
+        assert th.allclose(actions.std(dim=0), log_std.exp().expand_as(gaussian_mean), atol=2e-2)
+
+
+def test_sde_std_cache():
+    dist = StateDependentNoiseDistribution(N_ACTIONS)
+    _, log_std = dist.proba_distribution_net(N_FEATURES)
+    # Use a module so the parameter can be updated, loaded and converted
+    module = th.nn.Module()
+    module.log_std = log_std
+    optimizer = th.optim.SGD(module.parameters(), lr=0.1)
+
+    # The std and its square are re-used when no gradient is needed
+    with th.no_grad():
+        std = dist._get_cached_std(log_std)
+        assert dist._get_cached_std(log_std) is std
+        std_squared = dist._get_cached_std_squared(log_std)
+        assert dist._get_cached_std_squared(log_std) is std_squared
+        assert th.allclose(std_squared, std ** 2)
+
+    # Bypass the cache when the gradient is needed
+    std_with_grad = dist._get_cached_std(log_std)
+    assert std_with_grad.requires_grad
+    assert std_with_grad is not std
+    assert dist._get_cached_std(log_std) is not std_with_grad
+    assert dist._get_cached_std_squared(log_std).requires_grad
+
+    # The std must be recomputed after an optimizer step
+    std_with_grad.sum().backward()
+    optimizer.step()
+    with th.no_grad():
+        new_std = dist._get_cached_std(log_std)
+        assert new_std is not std
+        assert th.allclose(new_std, th.exp(log_std))
+        assert th.allclose(dist._get_cached_std_squared(log_std), th.exp(2 * log_std))
+        std = new_std
+
+    # And after loading new parameters
+    module.load_state_dict({"log_std": th.zeros_like(log_std)})
+    with th.no_grad():
+        new_std = dist._get_cached_std(log_std)
+        assert new_std is not std
+        assert th.allclose(new_std, th.ones_like(log_std))
+        std = new_std
+
+    # And when the storage or the dtype of the parameter change
+    module.double()
+    with th.no_grad():
+        new_std = dist._get_cached_std(log_std)
+        assert new_std is not std
+        assert new_std.dtype == th.float64
+        std = new_std
+
+    log_std.data = th.zeros_like(log_std) - 1.0
+    with th.no_grad():
+        new_std = dist._get_cached_std(log_std)
+        assert new_std is not std
+        assert th.allclose(new_std, th.exp(log_std))
+
+
+@pytest.mark.parametrize("dtype", [th.float32, th.float16, th.bfloat16])
+def test_sde_epsilon_dtype(dtype):
+    dist = StateDependentNoiseDistribution(N_ACTIONS)
+    epsilon = dist._get_epsilon(th.device("cpu"), dtype)
+    assert epsilon.dtype == dtype
+    assert epsilon.shape == (N_ACTIONS,)
+    # The default epsilon is representable in reduced precision and must not be changed
+    # (up to rounding, it is a subnormal number in float16)
+    assert th.allclose(epsilon.float(), th.full((N_ACTIONS,), dist.epsilon), rtol=5e-2)
+    # The tensor is only created once per device and dtype
+    assert dist._get_epsilon(th.device("cpu"), dtype) is epsilon
+
+
+def test_sde_sample_weights_backward():
+    batch_size = 4
+    dist = StateDependentNoiseDistribution(N_ACTIONS)
+    _, log_std = dist.proba_distribution_net(N_FEATURES)
+
+    dist.sample_weights(log_std, batch_size=batch_size)
+    first_matrices = dist.exploration_matrices
+    # Backpropagating through previous exploration matrices
+    # must still be possible after sampling new ones
+    dist.sample_weights(log_std, batch_size=batch_size)
+    second_matrices = dist.exploration_matrices
+    (first_matrices.sum() + second_matrices.sum()).backward()
+    assert log_std.grad is not None
+    assert not th.allclose(first_matrices, second_matrices)
+
+    # Without gradient, the noise buffer is re-used
+    with th.no_grad():
+        dist.sample_weights(log_std, batch_size=batch_size)
+        noise_buffer = dist._noise_buffer
+        dist.sample_weights(log_std, batch_size=batch_size)
+        assert dist._noise_buffer is noise_buffer
+        assert dist.exploration_matrices.shape == (batch_size, N_FEATURES, N_ACTIONS)
+
+
+def test_gaussian_log_prob():
+    set_random_seed(1)
+    batch_size = 100
+    # Use double precision for tight tolerances
+    mean_actions = th.randn(batch_size, N_ACTIONS, dtype=th.float64)
+    log_std = th.randn(N_ACTIONS, dtype=th.float64)
+    gaussian_actions = th.randn(batch_size, N_ACTIONS, dtype=th.float64) * 2.0
+    normal = Normal(mean_actions, log_std.exp())
+
+    expected_log_prob = normal.log_prob(gaussian_actions).sum(dim=-1)
+    assert th.allclose(diag_gaussian_log_prob(gaussian_actions, mean_actions, log_std), expected_log_prob)
+    dist = DiagGaussianDistribution(N_ACTIONS).proba_distribution(mean_actions, log_std)
+    assert th.allclose(dist.log_prob(gaussian_actions), expected_log_prob)
+
+    # Squashed Gaussian: change of variable with tanh
+    actions = th.tanh(gaussian_actions)
+    expected_log_prob = expected_log_prob - th.log(1.0 - actions ** 2).sum(dim=-1)
+    assert th.allclose(squashed_diag_gaussian_log_prob(gaussian_actions, mean_actions, log_std), expected_log_prob)
+    dist = SquashedDiagGaussianDistribution(N_ACTIONS).proba_distribution(mean_actions, log_std)
+    assert th.allclose(dist.log_prob(actions, gaussian_actions), expected_log_prob)
+
+
+def test_gaussian_entropy_and_kl():
+    set_random_seed(1)
+    batch_size = 100
+    mean_actions1 = th.randn(batch_size, N_ACTIONS, dtype=th.float64)
+    mean_actions2 = th.randn(batch_size, N_ACTIONS, dtype=th.float64)
+    log_std1 = th.randn(N_ACTIONS, dtype=th.float64)
+    log_std2 = th.randn(N_ACTIONS, dtype=th.float64)
+    normal1 = Normal(mean_actions1, log_std1.exp())
+    normal2 = Normal(mean_actions2, log_std2.exp())
+
+    dist1 = DiagGaussianDistribution(N_ACTIONS).proba_distribution(mean_actions1, log_std1)
+    dist2 = DiagGaussianDistribution(N_ACTIONS).proba_distribution(mean_actions2, log_std2)
+    assert th.allclose(dist1.entropy(), normal1.entropy().sum(dim=-1))
+    # Not summed across dimensions, as in PyTorch
+    assert th.allclose(kl_divergence(dist1, dist2), th.distributions.kl_divergence(normal1, normal2))
+
+
+def test_squashed_gaussian_log_prob_stability():
+    # Moderate values: same as the naive formula
+    gaussian_actions = th.linspace(-5.0, 5.0, 101, dtype=th.float64)
+    expected_correction = th.log(1.0 - th.tanh(gaussian_actions) ** 2)
+    assert th.allclose(tanh_squash_correction(gaussian_actions), expected_correction)
+
+    # Saturated values: the log probability must stay finite without epsilon
+    dist = SquashedDiagGaussianDistribution(N_ACTIONS)
+    _, log_std = dist.proba_distribution_net(N_FEATURES)
+    dist = dist.proba_distribution(th.zeros(2, N_ACTIONS), log_std)
+    gaussian_actions = th.tensor([[20.0] * N_ACTIONS, [-20.0] * N_ACTIONS])
+    actions = th.tanh(gaussian_actions)
+    assert th.isfinite(tanh_squash_correction(gaussian_actions)).all()
+    assert th.isfinite(dist.log_prob(actions, gaussian_actions)).all()
+    # The actions are clipped before inverting tanh
+    actions = th.tensor([[1.0] * N_ACTIONS, [-1.0] * N_ACTIONS])
+    assert th.isfinite(dist.log_prob(actions)).all()
+
+
+def test_bernoulli_mode():
+    set_random_seed(1)
+    action_logits = th.randn(100, N_ACTIONS)
+    # Include the edge case of a probability of exactly 0.5
+    action_logits[0] = 0.0
+    dist = BernoulliDistribution(N_ACTIONS).proba_distribution(action_logits)
+    mode = dist.mode()
+    assert mode.dtype == action_logits.dtype
+    assert th.equal(mode, th.round(th.sigmoid(action_logits)))
+
+
+def test_categorical_log_prob():
+    set_random_seed(1)
+    batch_size = 100
+    action_logits = th.randn(batch_size, N_ACTIONS + 3, dtype=th.float64)
+    actions = th.randint(N_ACTIONS + 3, (batch_size,))
+
+    dist = CategoricalDistribution(N_ACTIONS + 3).proba_distribution(action_logits)
+    # Actions are stored as float in the rollout buffer
+    assert th.allclose(dist.log_prob(actions.double()), Categorical(logits=action_logits).log_prob(actions))
+
+    action_dims = [2, 3]
+    action_logits = th.randn(batch_size, sum(action_dims), dtype=th.float64)
+    actions = th.stack([th.randint(action_dim, (batch_size,)) for action_dim in action_dims], dim=1)
+    expected_log_prob = sum(
+        Categorical(logits=logits).log_prob(action)
+        for logits, action in zip(th.split(action_logits, action_dims, dim=1), th.unbind(actions, dim=1))
+    )
+    dist = MultiCategoricalDistribution(action_dims).proba_distribution(action_logits)
+    assert th.allclose(dist.log_prob(actions), expected_log_prob)
+
+
 # TODO: analytical form for squashed Gaussian?
 @pytest.mark.parametrize(
     "dist",